@@ -1,91 +1,127 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import importlib
 import json
-from telethon import TelegramClient
+import logging
+from typing import Optional
+import msgspec
 import os
-import asyncio
 from dotenv import load_dotenv
 
-# Загружаем переменные окружения
-load_dotenv()
+# Выбираем самую быструю доступную библиотеку JSON один раз при импорте:
+# orjson, затем ujson и rapidjson, иначе стандартный json
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_dumps = json.dumps
+    for json_module_name in ('ujson', 'rapidjson'):
+        try:
+            json_dumps = importlib.import_module(json_module_name).dumps
+        except ImportError:
+            continue
+        break
+
+# Загружаем переменные окружения. На Vercel они уже заданы в окружении,
+# поэтому поиск файла .env пропускаем
+if os.getenv('VERCEL') is None:
+    load_dotenv()
+
+logger = logging.getLogger('telegram_bot')
 
 # Получаем данные для авторизации
-API_ID = int(os.getenv('API_ID', 0))
-API_HASH = os.getenv('API_HASH', '')
 BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 
-# Инициализируем клиент один раз
-client = None
+# Тексты ответов на команды
+START_MESSAGE = "👋 Привет! Я помогу вам управлять подписками на каналы Telegram."
+
+# Ответ на запросы с методом, отличным от POST
+METHOD_NOT_ALLOWED_BODY = json_dumps({
+    "status": "error",
+    "message": "Method not allowed"
+})
+
+# Схема обновления Telegram: описаны только поля, которые использует бот,
+# остальные msgspec пропускает при разборе
+class Chat(msgspec.Struct):
+    id: int
+
+class Message(msgspec.Struct):
+    chat: Chat
+    text: str = ''
 
-async def get_client():
-    """Получение или создание клиента"""
-    global client
-    if client is None:
-        client = TelegramClient('bot_session', API_ID, API_HASH)
-        await client.start(bot_token=BOT_TOKEN)
-    return client
+class Update(msgspec.Struct):
+    message: Optional[Message] = None
 
-async def handle_webhook(request_data):
+def cmd_start(chat_id, message):
+    """Обработчик команды /start"""
+    return {
+        'method': 'sendMessage',
+        'chat_id': chat_id,
+        'text': START_MESSAGE
+    }
+
+# Таблица команд: имя команды -> обработчик. Обработчик возвращает метод
+# Bot API, который Telegram выполнит из тела ответа на webhook, или None
+COMMANDS = {
+    '/start': cmd_start,
+}
+
+def handle_webhook(update: Update):
     """Обработка входящего webhook от Telegram"""
-    try:
-        client = await get_client()
-        
-        # Обрабатываем обновление
-        if 'message' in request_data:
-            message = request_data['message']
-            chat_id = message['chat']['id']
-            text = message.get('text', '')
-            
-            if text == '/start':
-                await client.send_message(chat_id, "👋 Привет! Я помогу вам управлять подписками на каналы Telegram.")
-        
-        return {"status": "success"}
-        
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+    message = update.message
+    if message:
+        command = COMMANDS.get(message.text.split(' ', 1)[0])
+        if command:
+            return command(message.chat.id, message)
+    return None
 
-async def handle_request(request):
-    """Асинхронный обработчик запроса"""
-    # Проверяем метод
-    if request.get('method', '') != 'POST':
-        return {
-            'statusCode': 405,
-            'body': json.dumps({
-                "status": "error",
-                "message": "Method not allowed"
-            })
-        }
-    
+def ack_and_dispatch(request):
+    """Обработка обновления и ответ Telegram в теле webhook"""
     try:
         # Получаем тело запроса
         body = request.get('body', '{}')
         if isinstance(body, str):
-            request_data = json.loads(body)
+            # Не разбираем JSON, если в обновлении нет ни одной команды
+            if not any(name in body for name in COMMANDS):
+                return {
+                    'statusCode': 200,
+                    'body': 'OK'
+                }
+            update = msgspec.json.decode(body, type=Update)
         else:
-            request_data = body
-            
-        # Обрабатываем webhook
-        response = await handle_webhook(request_data)
+            update = msgspec.convert(body, Update)
+        
+        # Ответ возвращаем прямо в теле, без отдельного запроса к Bot API
+        reply = handle_webhook(update)
+        if reply:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json_dumps(reply)
+            }
         
         return {
             'statusCode': 200,
-            'body': json.dumps(response)
+            'body': 'OK'
         }
         
     except Exception as e:
+        # Ошибку не возвращаем Telegram: на 5xx он повторяет доставку и
+        # усиливает нагрузку, поэтому подтверждаем обновление и логируем
+        logger.exception(f"Ошибка при обработке обновления: {e}")
         return {
-            'statusCode': 500,
-            'body': json.dumps({
-                "status": "error",
-                "message": str(e)
-            })
+            'statusCode': 200,
+            'body': 'OK'
         }
 
 def handler(request):
     """Основной обработчик для Vercel"""
-    if asyncio.get_event_loop().is_closed():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    else:
-        loop = asyncio.get_event_loop()
-    
-    return loop.run_until_complete(handle_request(request)) 
\ No newline at end of file
+    # Проверяем метод до любой работы с обновлением
+    if request.get('method', '') != 'POST':
+        return {
+            'statusCode': 405,
+            'body': METHOD_NOT_ALLOWED_BODY
+        }
+    return ack_and_dispatch(request)
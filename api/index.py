@@ -1,53 +1,111 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import importlib
 import json
+import logging
 import os
 import sys
+import threading
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from src.bot import TelegramBot
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
 
+# uvloop (libuv) быстрее стандартного цикла asyncio; на Linux он доступен
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Выбираем самую быструю доступную библиотеку JSON один раз при импорте:
+# orjson, затем ujson и rapidjson, иначе стандартный json
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+    for json_module_name in ('ujson', 'rapidjson'):
+        try:
+            json_loads = importlib.import_module(json_module_name).loads
+        except ImportError:
+            continue
+        break
+
+logger = logging.getLogger('telegram_bot')
+
+# Единственный экземпляр бота на процесс. Его создание защищено блокировкой:
+# обновления обрабатываются в нескольких потоках, а второй экземпляр открыл бы
+# свой дескриптор файла блокировок сессий, и при его закрытии процесс потерял
+# бы все блокировки lockf на этом файле
 bot = None
+bot_lock = threading.Lock()
 
-def init_bot():
+def get_bot():
+    """Создание бота при первом обновлении"""
     global bot
     if bot is None:
-        bot = TelegramBot()
-
-class WebhookHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        update = json.loads(post_data.decode('utf-8'))
-        
-        init_bot()
-        
-        # Обработка обновления от Telegram
-        try:
-            bot.handle_update(update)
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b'OK')
-        except Exception as e:
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(str(e).encode('utf-8'))
+        with bot_lock:
+            if bot is None:
+                # Telethon импортируется только здесь, чтобы холодный старт и запросы,
+                # не требующие бота, не платили за загрузку его зависимостей
+                from src.bot import TelegramBot
+                try:
+                    bot = TelegramBot()
+                except Exception as e:
+                    logger.error(f"Ошибка при создании бота: {str(e)}")
+                    raise
+    return bot
+
+# Пул потоков для обработки обновлений после ответа Telegram
+executor = ThreadPoolExecutor(max_workers=4)
+
+def process_update(update):
+    """Фоновая обработка обновления, чтобы ошибки не терялись"""
+    try:
+        get_bot().handle_update(update)
+    except Exception as e:
+        logger.exception(f"Ошибка при обработке обновления: {e}")
+
+async def webhook(request):
+    """Асинхронный обработчик webhook от Telegram"""
+    body = await request.body()
+    try:
+        update = json_loads(body)
+    except Exception as e:
+        # На 5xx Telegram повторяет доставку, поэтому подтверждаем и логируем
+        logger.exception(f"Ошибка при разборе обновления: {e}")
+        return PlainTextResponse('OK')
+    
+    # Обработка обновления от Telegram выполняется после ответа
+    executor.submit(process_update, update)
+    return PlainTextResponse('OK')
+
+app = Starlette(routes=[Route('/', webhook, methods=['POST'])])
 
 def handler(event, context):
-    if event['httpMethod'] == 'POST':
-        try:
-            body = json.loads(event['body'])
-            init_bot()
-            bot.handle_update(body)
-            return {
-                'statusCode': 200,
-                'body': 'OK'
-            }
-        except Exception as e:
-            return {
-                'statusCode': 500,
-                'body': str(e)
-            }
-    else:
+    if event['httpMethod'] != 'POST':
         return {
             'statusCode': 405,
             'body': 'Method not allowed'
-        } 
\ No newline at end of file
+        }
+    
+    try:
+        body = json_loads(event['body'])
+        executor.submit(process_update, body)
+        return {
+            'statusCode': 200,
+            'body': 'OK'
+        }
+    except Exception as e:
+        # На 5xx Telegram повторяет доставку, поэтому подтверждаем и логируем
+        logger.exception(f"Ошибка при разборе обновления: {e}")
+        return {
+            'statusCode': 200,
+            'body': 'OK'
+        }
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, loop='uvloop', http='httptools')
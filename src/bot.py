@@ -4,17 +4,21 @@ import sys
 import logging
 import asyncio
 import fcntl
-import tempfile
 import shutil
-from typing import List, Optional, Dict, Tuple
+import threading
+from typing import List, Optional, Dict, Tuple, Iterable, Union
 from datetime import datetime, timedelta
 from contextlib import contextmanager
+from collections import deque
+from itertools import chain
+# cryptg подхватывается Telethon при импорте и шифрует трафик MTProto на C
+import cryptg
 from telethon import TelegramClient, events, Button
 from telethon.sessions import StringSession
 from telethon.tl.functions.channels import JoinChannelRequest, GetParticipantsRequest
 from telethon.tl.functions.messages import ImportChatInviteRequest, GetMessagesRequest, SendMessageRequest, GetDialogsRequest
 from telethon.tl.functions.users import GetFullUserRequest
-from telethon.tl.types import ChannelParticipantsSearch, User, Channel, Message, InputPeerEmpty
+from telethon.tl.types import ChannelParticipantsSearch, User, Channel, Message, InputPeerEmpty, MessageMediaPhoto, MessageMediaDocument
 from telethon.errors import (
     FloodWaitError,
     ChatWriteForbiddenError,
@@ -27,6 +31,7 @@ from telethon.errors import (
     PhoneCodeInvalidError
 )
 from dotenv import load_dotenv
+from aiolimiter import AsyncLimiter
 import csv
 from docx import Document
 from openpyxl import load_workbook
@@ -35,6 +40,7 @@ from PIL import Image
 from io import BytesIO
 import pytesseract
 import re
+import operator
 import xlrd
 import textract
 import PyPDF2
@@ -42,6 +48,8 @@ import striprtf.striprtf
 from odf import opendocument
 from odf.table import Table, TableRow, TableCell
 import json
+import zlib
+import weakref
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -63,20 +71,127 @@ logging.basicConfig(
 )
 logger = logging.getLogger('telegram_bot')
 
+# Регулярные выражения компилируются один раз при загрузке модуля
+# Ссылки на каналы: приглашение, публичная ссылка, @username или имя
+# канала отдельной строкой (в том числе с окончаниями строк CRLF)
+CHAT_LINK_RE = re.compile(
+    r'(?:https?://)?(?:t|telegram)\.me/(?:joinchat/|\+)(?P<invite>[a-zA-Z0-9_-]+)'
+    r'|(?:https?://)?(?:t|telegram)\.me/(?P<username>[a-zA-Z0-9_]+)'
+    r'|(?:^|(?<=\s))@(?P<at>[a-zA-Z0-9_]+)'
+    r'|^[ \t]*(?P<bare>[a-zA-Z0-9_]+)[ \t\r]*$',
+    re.MULTILINE
+)
+
+# Ссылки t.me и @username в загруженных файлах со списками каналов
+FILE_LINK_RE = re.compile(
+    r'(?:https?://)?(?:t|telegram)\.me/(?:joinchat/|\+)(?P<invite>[a-zA-Z0-9_-]+)'
+    r'|(?:https?://)?(?:t|telegram)\.me/(?P<username>[a-zA-Z0-9_]+)'
+    r'|@(?P<at>[a-zA-Z][a-zA-Z0-9_]{3,})(?=\s|$)',
+    re.ASCII
+)
+
+# Начала значений ячеек Excel, в которых может быть ссылка на канал
+CHAT_LINK_PREFIXES = ('https://t.me/', 'http://t.me/', '@', 't.me/')
+
+# Сигнатуры файлов Excel: xlsx (zip-архив) и xls (OLE)
+XLSX_MAGIC = b'PK\x03\x04'
+XLS_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# Задания капчи и арифметические операции для них
+CAPTCHA_ARITHMETIC_RE = re.compile(r'what\s+is\s+(\d+)\s*([+\-*/])\s*(\d+)')
+CAPTCHA_TYPE_WORD_RE = re.compile(r'type\s+the\s+word\s+"([^"]+)"')
+CAPTCHA_CLICK_BUTTON_RE = re.compile(r'click\s+the\s+button\s+with\s+the\s+word\s+"([^"]+)"')
+CAPTCHA_OPERATIONS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.floordiv
+}
+
+# Лимиты вступлений в каналы в сутки
+JOINS_PER_DAY = 200
+PREMIUM_JOINS_PER_DAY = 300
+CONNECT_ATTEMPTS = 3  # Число попыток подключения к Telegram при сетевых ошибках
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024  # Максимальный размер файла со списком каналов, байты
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Размер части при скачивании файла со списком, байты
+CLEANUP_INTERVAL = 3600  # Интервал между очистками временных файлов, секунды
+ACCOUNT_IDLE_TIMEOUT = 3600  # Простой, после которого аккаунт пользователя отключается, секунды
+MAX_ACCOUNTS = 200  # Максимальное число одновременно подключенных аккаунтов пользователей
+ME_CACHE_TTL = 300  # Время жизни кэша данных пользователя (get_me), секунды
+DIALOGS_CACHE_TTL = 30  # Время жизни кэша списка диалогов, секунды
+ACCOUNT_INFO_TTL = 60  # Время жизни кэша информации об аккаунте, секунды
+STATUS_UPDATE_INTERVAL = 2  # Минимальный интервал между правками сообщения со статусом, секунды
+
+# Шаблон приветствия для /start, подставляется из словаря account_info
+WELCOME_BACK_TEMPLATE = (
+    "👋 С возвращением!\n\n"
+    "👤 Пользователь: {first_name}\n"
+    "📱 Телефон: {phone}\n"
+    "💎 Тип аккаунта: {account_type}\n\n"
+    "📊 Статистика чатов:\n"
+    "📢 Каналы: {channels}\n"
+    "👥 Большие группы (>200): {large_groups}\n"
+    "👥 Малые группы (≤200): {small_groups}\n"
+    "👤 Личные чаты: {private_chats}\n"
+    "📱 Всего чатов: {total_chats}\n\n"
+    "📈 Лимиты:\n"
+    "📊 Каналы + большие группы: {limited_chats}/{limits[max_limited_chats]}\n"
+    "➕ Доступно для вступления: {available_joins}\n"
+    "📥 Лимит вступлений в день: {limits[joins_per_day]}"
+)
+
+def join_interval(premium: bool) -> float:
+    """Интервал между вступлениями в секундах, равномерно распределяющий суточный лимит"""
+    return 86400 / (PREMIUM_JOINS_PER_DAY if premium else JOINS_PER_DAY)
+
+def chat_link_from_match(match: re.Match) -> str:
+    """Каноническая ссылка на канал по совпадению CHAT_LINK_RE или FILE_LINK_RE"""
+    # В каждой ветке выражений ровно одна именованная группа
+    name = match.lastgroup
+    if name == 'invite':
+        return f"https://t.me/joinchat/{match.group(name)}"
+    return f"https://t.me/{match.group(name)}"
+
+# Клиенты Telegram по имени сессии, общие для всех UserAccount процесса
+TELEGRAM_CLIENTS: Dict[str, TelegramClient] = {}
+
+async def disconnect_all_clients():
+    """Отключение всех закэшированных клиентов при завершении работы"""
+    for session_name, client in list(TELEGRAM_CLIENTS.items()):
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.error(f"Ошибка при отключении клиента {session_name}: {str(e)}")
+    TELEGRAM_CLIENTS.clear()
+
 class SessionManager:
     def __init__(self, session_dir: str):
         self.session_dir = session_dir
         self.locks = {}
-        self.lock_files = {}
+        # Все сессии блокируются байтовыми диапазонами одного общего файла
+        self.lock_fd = os.open(os.path.join(session_dir, '.locks'), os.O_RDWR | os.O_CREAT)
+        # Закрытие дескриптора снимает все блокировки процесса на файле.
+        # finalize срабатывает детерминированно и при завершении интерпретатора,
+        # в отличие от __del__
+        self.finalizer = weakref.finalize(self, os.close, self.lock_fd)
+
+    @staticmethod
+    def lock_offset(session_name: str) -> int:
+        """Смещение байта блокировки для сессии"""
+        # crc32 не зависит от процесса, в отличие от встроенного hash()
+        return zlib.crc32(session_name.encode('utf-8'))
 
     def acquire_lock(self, session_name: str) -> bool:
         """Получение блокировки для сессии"""
         try:
-            lock_file = os.path.join(self.session_dir, f"{session_name}.lock")
-            f = open(lock_file, 'w')
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            self.locks[session_name] = f
-            self.lock_files[session_name] = lock_file
+            # Блокировки lockf принадлежат процессу, поэтому повторный захват
+            # внутри процесса проверяем сами
+            if session_name in self.locks:
+                logger.error(f"Сессия {session_name} уже используется")
+                return False
+            offset = self.lock_offset(session_name)
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            self.locks[session_name] = offset
             return True
         except IOError:
             logger.error(f"Сессия {session_name} уже используется")
@@ -89,23 +204,57 @@ class SessionManager:
         """Освобождение блокировки сессии"""
         try:
             if session_name in self.locks:
-                f = self.locks.pop(session_name)
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
-                
-                lock_file = self.lock_files.pop(session_name, None)
-                if lock_file and os.path.exists(lock_file):
-                    try:
-                        os.remove(lock_file)
-                    except OSError:
-                        pass
+                offset = self.locks.pop(session_name)
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, 1, offset)
         except Exception as e:
             logger.error(f"Ошибка при освобождении блокировки: {str(e)}")
 
-    def __del__(self):
-        """Освобождение всех блокировок при уничтожении объекта"""
-        for session_name in list(self.locks.keys()):
-            self.release_lock(session_name)
+class BytesIOPool:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffers = deque(BytesIO() for _ in range(capacity))
+        self.lock = threading.Lock()
+
+    def acquire(self) -> BytesIO:
+        """Получение буфера из пула или создание нового"""
+        with self.lock:
+            if self.buffers:
+                return self.buffers.pop()
+        return BytesIO()
+
+    def release(self, buffer: BytesIO):
+        """Сброс буфера и возврат его в пул"""
+        buffer.seek(0)
+        buffer.truncate(0)
+        with self.lock:
+            if len(self.buffers) < self.capacity:
+                self.buffers.append(buffer)
+
+# Буферы для скачивания изображений капчи переиспользуются между вызовами
+BYTESIO_POOL = BytesIOPool(8)
+
+class TTLEntry:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.value = None
+        self.updated = 0.0
+
+    def get(self, max_age: Optional[float] = None):
+        """Значение, если оно не старше max_age секунд (по умолчанию ttl), иначе None"""
+        if max_age is None:
+            max_age = self.ttl
+        if self.value is not None and time.monotonic() - self.updated < max_age:
+            return self.value
+        return None
+
+    def set(self, value):
+        """Сохранение значения с текущим временем"""
+        self.value = value
+        self.updated = time.monotonic()
+
+    def invalidate(self):
+        """Сброс значения"""
+        self.value = None
 
 class ResourceManager:
     @staticmethod
@@ -117,20 +266,36 @@ class ResourceManager:
         finally:
             file.close()
 
+    @staticmethod
+    @contextmanager
+    def managed_bytesio():
+        """Контекстный менеджер для буфера из пула"""
+        buffer = BYTESIO_POOL.acquire()
+        try:
+            yield buffer
+        finally:
+            BYTESIO_POOL.release(buffer)
+
     @staticmethod
     def cleanup_old_files(directory: str, max_age_hours: int = 24):
         """Очистка старых файлов"""
         try:
-            current_time = datetime.now()
-            for filename in os.listdir(directory):
-                filepath = os.path.join(directory, filename)
-                try:
-                    file_time = datetime.fromtimestamp(os.path.getctime(filepath))
-                    if (current_time - file_time).total_seconds() > max_age_hours * 3600:
-                        os.remove(filepath)
-                        logger.info(f"Удален старый файл: {filepath}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении файла {filepath}: {str(e)}")
+            cutoff = time.time() - max_age_hours * 3600
+            removed = []
+            # scandir отдает stat из кэша записи каталога без лишних системных вызовов
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Скрытые служебные файлы (например, общий файл блокировок) не трогаем
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.stat().st_ctime < cutoff:
+                            os.unlink(entry.path)
+                            removed.append(entry.path)
+                    except OSError as e:
+                        logger.error(f"Ошибка при удалении файла {entry.path}: {str(e)}")
+            if removed:
+                logger.info(f"Удалено старых файлов в {directory}: {len(removed)}")
         except Exception as e:
             logger.error(f"Ошибка при очистке директории {directory}: {str(e)}")
 
@@ -146,7 +311,49 @@ class UserAccount:
         self.phone_code_hash = None
         self.captcha_tasks = {}
         self.join_count = 0  # Счетчик вступлений
-        self.current_delay = 10  # Начальная пауза 10 секунд
+        self.join_limiter = None  # Ограничитель частоты вступлений, создается при первом вступлении
+        self.pending_status = None  # Последний текст статуса, еще не отправленный в чат
+        # Данные пользователя меняются редко, список диалогов устаревает быстро
+        self.me_cache = TTLEntry(ME_CACHE_TTL)
+        self.dialogs_cache = TTLEntry(DIALOGS_CACHE_TTL)
+
+    def get_client(self) -> TelegramClient:
+        """Получение клиента сессии из общего кэша или создание нового"""
+        client = TELEGRAM_CLIENTS.get(self.session_name)
+        if client is None:
+            logger.info("Создаю клиент...")
+            # Используем только имя сессии, без пути
+            client = TelegramClient(self.session_name, self.api_id, self.api_hash)
+            TELEGRAM_CLIENTS[self.session_name] = client
+        return client
+
+    async def ensure_connected(self):
+        """Подключение клиента к Telegram с повторными попытками"""
+        client = self.client
+        if client is None:
+            raise RuntimeError("Клиент не инициализирован")
+        if client.is_connected():
+            return
+        
+        logger.info("Подключаюсь к Telegram...")
+        # Временные сетевые ошибки повторяем с экспоненциальной задержкой
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                await client.connect()
+                return
+            except (ConnectionError, OSError) as e:
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Не удалось подключиться к Telegram (попытка {attempt + 1}): {str(e)}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def resume_session(self) -> bool:
+        """Подключение к сохраненной сессии без запроса кода подтверждения"""
+        if not self.session_manager.acquire_lock(self.session_name):
+            return False
+        self.client = self.get_client()
+        await self.ensure_connected()
+        return await self.client.is_user_authorized()
 
     async def start_client(self):
         """Запуск клиента"""
@@ -154,12 +361,9 @@ class UserAccount:
             if not self.session_manager.acquire_lock(self.session_name):
                 return False
 
-            logger.info("Создаю клиент...")
-            # Используем только имя сессии, без пути
-            self.client = TelegramClient(self.session_name, self.api_id, self.api_hash)
+            self.client = self.get_client()
             
-            logger.info("Подключаюсь к Telegram...")
-            await self.client.connect()
+            await self.ensure_connected()
             
             # Проверяем авторизацию
             if await self.client.is_user_authorized():
@@ -204,12 +408,9 @@ class UserAccount:
         try:
             # Создаем и подключаем клиент, если его еще нет
             if not self.client:
-                logger.info("Создаю клиент...")
-                self.client = TelegramClient(self.session_name, self.api_id, self.api_hash)
+                self.client = self.get_client()
                 
-            if not self.client.is_connected():
-                logger.info("Подключаюсь к Telegram...")
-                await self.client.connect()
+            await self.ensure_connected()
                 
             # Проверяем, не авторизован ли уже клиент
             if await self.client.is_user_authorized():
@@ -254,9 +455,7 @@ class UserAccount:
                 logger.error("Клиент не инициализирован")
                 return False
                 
-            if not self.client.is_connected():
-                logger.info("Подключаюсь к Telegram...")
-                await self.client.connect()
+            await self.ensure_connected()
                 
             if not self.phone_code_hash:
                 logger.error("Отсутствует phone_code_hash")
@@ -284,8 +483,8 @@ class UserAccount:
         """Отключение от аккаунта"""
         try:
             if self.client:
+                # Клиент остается в кэше, чтобы повторное подключение его переиспользовало
                 await self.client.disconnect()
-                self.client = None
                 self.phone_code_hash = None
                 
                 # Освобождаем блокировку
@@ -296,6 +495,27 @@ class UserAccount:
         except Exception as e:
             logger.error(f"Ошибка при отключении: {str(e)}")
 
+    async def get_cached_me_and_dialogs(self, max_age: Optional[float] = None) -> Tuple:
+        """Информация о пользователе и диалоги, устаревшие части запрашиваются заново"""
+        me = self.me_cache.get()
+        dialogs = self.dialogs_cache.get(max_age)
+        
+        # Запросы независимы друг от друга, поэтому выполняем их параллельно
+        if me is None and dialogs is None:
+            me, dialogs = await asyncio.gather(
+                self.client.get_me(),
+                self.client.get_dialogs()
+            )
+            self.me_cache.set(me)
+            self.dialogs_cache.set(dialogs)
+        elif me is None:
+            me = await self.client.get_me()
+            self.me_cache.set(me)
+        elif dialogs is None:
+            dialogs = await self.client.get_dialogs()
+            self.dialogs_cache.set(dialogs)
+        return me, dialogs
+
     async def get_account_info(self):
         """Получение информации об аккаунте"""
         try:
@@ -303,37 +523,43 @@ class UserAccount:
                 logger.error("Клиент не инициализирован")
                 return None
                 
-            if not self.client.is_connected():
-                logger.info("Подключаюсь к Telegram...")
-                await self.client.connect()
+            await self.ensure_connected()
                 
             if not await self.client.is_user_authorized():
                 logger.error("Клиент не авторизован")
                 return None
 
-            # Получаем информацию о пользователе
-            me = await self.client.get_me()
-            full_user = await self.client.get_entity(me.id)
-
-            # Получаем список диалогов для подсчета каналов
-            dialogs = await self.client.get_dialogs()
+            # Получаем информацию о пользователе и список диалогов для подсчета каналов
+            me, dialogs = await self.get_cached_me_and_dialogs()
             
-            # Считаем разные типы чатов
-            channels = sum(1 for d in dialogs if d.is_channel)
-            large_groups = sum(1 for d in dialogs if d.is_group and hasattr(d.entity, 'participants_count') and d.entity.participants_count > 200)
-            small_groups = sum(1 for d in dialogs if d.is_group and hasattr(d.entity, 'participants_count') and d.entity.participants_count <= 200)
-            private_chats = sum(1 for d in dialogs if d.is_user)
+            # Считаем разные типы чатов за один проход по диалогам.
+            # Супергруппа одновременно и канал, и группа, поэтому проверки независимы
+            channels = large_groups = small_groups = private_chats = 0
+            for d in dialogs:
+                if d.is_user:
+                    private_chats += 1
+                    continue
+                if d.is_channel:
+                    channels += 1
+                if d.is_group:
+                    participants_count = getattr(d.entity, 'participants_count', None)
+                    if participants_count is not None:
+                        if participants_count > 200:
+                            large_groups += 1
+                        else:
+                            small_groups += 1
             
             # Считаем чаты, которые учитываются в лимите
+            premium = me.premium
             limited_chats = channels + large_groups
-            max_limited_chats = 1000 if me.premium else 500
+            max_limited_chats = 1000 if premium else 500
 
             # Формируем информацию об аккаунте
             account_info = {
                 'first_name': me.first_name or "Без имени",
                 'username': me.username or "Без username",
                 'phone': self.phone,
-                'account_type': "Premium" if me.premium else "Обычный",
+                'account_type': "Premium" if premium else "Обычный",
                 'channels': channels,
                 'large_groups': large_groups,
                 'small_groups': small_groups,
@@ -342,7 +568,7 @@ class UserAccount:
                 'limited_chats': limited_chats,
                 'limits': {
                     'max_limited_chats': max_limited_chats,
-                    'joins_per_day': 300 if me.premium else 200
+                    'joins_per_day': PREMIUM_JOINS_PER_DAY if premium else JOINS_PER_DAY
                 },
                 'available_joins': max_limited_chats - limited_chats
             }
@@ -353,148 +579,149 @@ class UserAccount:
             logger.error(f"Ошибка при получении информации об аккаунте: {str(e)}")
             return None
 
-    async def extract_chat_links(self, text: str) -> List[str]:
-        """Извлечение ссылок на каналы из текста"""
-        links = []
-        seen_links = set()
+    @staticmethod
+    def extract_chat_links(text: Union[str, Iterable[str]]) -> List[str]:
+        """Извлечение ссылок на каналы из текста или списка строк"""
+        # dict сохраняет порядок вставки и сразу убирает дубликаты
+        links = {}
+        debug = logger.isEnabledFor(logging.DEBUG)
         
-        # Разбиваем текст на строки и обрабатываем каждую отдельно
-        for line in text.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Обрабатываем приватные ссылки
-            if 'joinchat' in line or '+' in line:
-                match = re.search(r'(?:https?://)?(?:t|telegram)\.me/(?:joinchat/|\+)([a-zA-Z0-9_-]+)', line)
-                if match:
-                    invite_hash = match.group(1)
-                    link = f"https://t.me/joinchat/{invite_hash}"
-                    if link not in seen_links:
-                        links.append(link)
-                        seen_links.add(link)
-                        logger.info(f"Обработана приватная ссылка: {link}")
-                    continue
-            
-            # Обрабатываем публичные ссылки и юзернеймы
-            if line.startswith('@'):
-                username = line[1:]
-            elif line.startswith(('https://', 'http://', 't.me')):
-                username = re.sub(r'^(?:https?://)?(?:t\.me/)?', '', line)
-            else:
-                username = line
-            
-            # Добавляем ссылку без дополнительных проверок
-            if username:
-                link = f"https://t.me/{username}"
-                if link not in seen_links:
-                    links.append(link)
-                    seen_links.add(link)
-                    logger.info(f"Обработана публичная ссылка: {link}")
+        if isinstance(text, str):
+            # Весь текст разбирается за один проход общего регулярного выражения
+            matches = CHAT_LINK_RE.finditer(text)
+        else:
+            # Список разбираем поэлементно тем же поиском, не склеивая его в одну строку
+            matches = chain.from_iterable(CHAT_LINK_RE.finditer(item) for item in text)
         
-        return links
+        for match in matches:
+            link = chat_link_from_match(match)
+            links[link] = None
+            if debug:
+                logger.debug("Обработана ссылка: %s", link)
+        
+        return list(links)
+
+    async def download_captcha(self, message: Message, buffer: BytesIO) -> Optional[BytesIO]:
+        """Скачивание изображения капчи из сообщения в переданный буфер"""
+        if not message or not message.media:
+            return None
+        
+        # Не скачиваем медиа, которое заведомо не изображение
+        message_media = message.media
+        if not isinstance(message_media, MessageMediaPhoto) and not (
+            isinstance(message_media, MessageMediaDocument)
+            and message_media.document
+            and message_media.document.mime_type.startswith("image/")
+        ):
+            return None
+        
+        media = await self.client.download_media(message_media, file=buffer)
+        if isinstance(media, BytesIO):
+            return media
+        return None
 
-    async def save_captcha_screenshot(self, chat, message: Message) -> Optional[str]:
+    async def save_captcha_screenshot(self, chat, message: Message, image_bytes: Optional[BytesIO] = None) -> Optional[str]:
         """Сохранение скриншота сообщения с капчей"""
         try:
-            if not message or not message.media:
-                return None
-                
-            # Скачиваем медиа из сообщения
-            media = await self.client.download_media(message.media, file=BytesIO())
-            if not media:
-                return None
-                
-            # Создаем имя файла с timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"captcha_{chat.id}_{timestamp}.png"
-            filepath = os.path.join(SCREENSHOTS_DIR, filename)
-            
-            # Сохраняем изображение
-            if isinstance(media, BytesIO):
-                image = Image.open(media)
-                image.save(filepath)
-                logger.info(f"Скриншот капчи сохранен: {filepath}")
-                return filepath
-            return None
+            # Скачиваем медиа из сообщения, если его не передали заранее
+            if image_bytes is None:
+                with ResourceManager.managed_bytesio() as buffer:
+                    image_bytes = await self.download_captcha(message, buffer)
+                    if not image_bytes:
+                        return None
+                    return self.save_captcha_image(chat, self.open_captcha_image(image_bytes))
+            return self.save_captcha_image(chat, self.open_captcha_image(image_bytes))
             
         except Exception as e:
             logger.error(f"Ошибка при сохранении скриншота капчи: {str(e)}")
             return None
 
-    async def process_captcha(self, chat, message: Message) -> Optional[str]:
+    @staticmethod
+    def open_captcha_image(image_bytes: BytesIO) -> Image.Image:
+        """Открытие скачанного изображения капчи с начала буфера"""
+        image_bytes.seek(0)
+        return Image.open(image_bytes)
+
+    def save_captcha_image(self, chat, image: Image.Image) -> str:
+        """Сохранение изображения капчи на диск"""
+        # Создаем имя файла с timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"captcha_{chat.id}_{timestamp}.png"
+        filepath = os.path.join(SCREENSHOTS_DIR, filename)
+        
+        # Сохраняем изображение
+        image.save(filepath)
+        logger.info(f"Скриншот капчи сохранен: {filepath}")
+        return filepath
+
+    async def process_captcha(self, chat, message: Message, image_bytes: Optional[BytesIO] = None) -> Optional[str]:
         """Обработка капчи на изображении"""
         try:
-            if not message or not message.media:
-                return None
-                
-            # Скачиваем медиа из сообщения
-            media = await self.client.download_media(message.media, file=BytesIO())
-            if not media:
-                return None
-                
-            # Создаем имя файла с timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"captcha_{chat.id}_{timestamp}.png"
-            filepath = os.path.join(SCREENSHOTS_DIR, filename)
-            
-            # Сохраняем изображение
-            if isinstance(media, BytesIO):
-                image = Image.open(media)
-                image.save(filepath)
-                
-                # Распознаем текст на изображении
-                text = pytesseract.image_to_string(image, lang='eng')
-                logger.info(f"Распознанный текст капчи: {text}")
-                
-                # Ищем задание в тексте
-                task_match = re.search(r'what\s+is\s+(\d+)\s*[\+\-\*\/]\s*(\d+)', text.lower())
-                if task_match:
-                    num1 = int(task_match.group(1))
-                    num2 = int(task_match.group(2))
-                    operator = re.search(r'[\+\-\*\/]', text).group()
-                    
-                    # Вычисляем результат
-                    if operator == '+':
-                        result = num1 + num2
-                    elif operator == '-':
-                        result = num1 - num2
-                    elif operator == '*':
-                        result = num1 * num2
-                    elif operator == '/':
-                        result = num1 / num2
-                    else:
+            # Скачиваем медиа из сообщения, если его не передали заранее
+            if image_bytes is None:
+                with ResourceManager.managed_bytesio() as buffer:
+                    image_bytes = await self.download_captcha(message, buffer)
+                    if not image_bytes:
                         return None
-                        
-                    logger.info(f"Задание: {num1} {operator} {num2} = {result}")
-                    return str(result)
-                    
-                # Ищем другие типы заданий
-                if "type the word" in text.lower():
-                    word_match = re.search(r'type\s+the\s+word\s+"([^"]+)"', text.lower())
-                    if word_match:
-                        word = word_match.group(1)
-                        logger.info(f"Задание: написать слово '{word}'")
-                        return word
-                        
-                if "click the button" in text.lower():
-                    button_match = re.search(r'click\s+the\s+button\s+with\s+the\s+word\s+"([^"]+)"', text.lower())
-                    if button_match:
-                        word = button_match.group(1)
-                        logger.info(f"Задание: нажать кнопку со словом '{word}'")
-                        return word
-                        
-            return None
+                    return self.recognize_captcha(chat, image_bytes)
+            return self.recognize_captcha(chat, image_bytes)
             
         except Exception as e:
             logger.error(f"Ошибка при обработке капчи: {str(e)}")
             return None
 
+    def recognize_captcha(self, chat, image_bytes: BytesIO) -> Optional[str]:
+        """Распознавание задания капчи на скачанном изображении"""
+        image = self.open_captcha_image(image_bytes)
+        image.load()
+        
+        # Копия на диске нужна только для отладки; для архива есть save_captcha_screenshot
+        if logger.isEnabledFor(logging.DEBUG):
+            self.save_captcha_image(chat, image)
+        
+        # Распознаем текст на изображении
+        # Капча - короткая строка, поэтому анализ разметки страницы не нужен
+        text = pytesseract.image_to_string(image, lang='eng', config='--psm 7 --oem 1')
+        logger.info(f"Распознанный текст капчи: {text}")
+        
+        # Ищем задание в тексте
+        lowered_text = text.lower()
+        task_match = CAPTCHA_ARITHMETIC_RE.search(lowered_text)
+        if task_match:
+            num1 = int(task_match.group(1))
+            sign = task_match.group(2)
+            num2 = int(task_match.group(3))
+            
+            # Вычисляем результат
+            result = CAPTCHA_OPERATIONS[sign](num1, num2)
+            logger.info(f"Задание: {num1} {sign} {num2} = {result}")
+            return str(result)
+            
+        # Ищем другие типы заданий
+        word_match = CAPTCHA_TYPE_WORD_RE.search(lowered_text)
+        if word_match:
+            word = word_match.group(1)
+            logger.info(f"Задание: написать слово '{word}'")
+            return word
+                
+        button_match = CAPTCHA_CLICK_BUTTON_RE.search(lowered_text)
+        if button_match:
+            word = button_match.group(1)
+            logger.info(f"Задание: нажать кнопку со словом '{word}'")
+            return word
+
+        return None
+
     async def solve_captcha(self, chat, message: Message) -> bool:
         """Решение капчи и отправка ответа"""
         try:
-            # Обрабатываем капчу
-            answer = await self.process_captcha(chat, message)
+            # Скачиваем изображение один раз и используем его для обработки капчи
+            with ResourceManager.managed_bytesio() as buffer:
+                image_bytes = await self.download_captcha(message, buffer)
+                if not image_bytes:
+                    logger.error("Сообщение не содержит изображения капчи")
+                    return False
+                answer = await self.process_captcha(chat, message, image_bytes)
             if not answer:
                 logger.error("Не удалось распознать задание капчи")
                 return False
@@ -513,8 +740,10 @@ class UserAccount:
             logger.error(f"Ошибка при решении капчи: {str(e)}")
             return False
 
-    async def join_chats(self, chat_links: List[str], status_msg) -> Dict:
-        results = {
+    @staticmethod
+    def new_join_results() -> Dict:
+        """Пустые результаты вступления в каналы"""
+        return {
             "success": 0,
             "failed": 0,
             "failed_chats": [],
@@ -524,6 +753,83 @@ class UserAccount:
             "already_member": 0  # Добавляем счетчик уже существующих подписок
         }
 
+    def ensure_join_limiter(self, me: User):
+        """Создание ограничителя частоты вступлений по типу аккаунта"""
+        # Ограничитель живет вместе с аккаунтом, чтобы квота учитывалась между списками
+        if self.join_limiter is None:
+            # Емкость 1: без начального всплеска, даже у только что созданного ограничителя
+            # вступления идут не чаще одного раза в join_interval секунд
+            self.join_limiter = AsyncLimiter(1, join_interval(me.premium))
+
+    async def status_pump(self, status_msg):
+        """Периодическое обновление сообщения со статусом последним текстом"""
+        while True:
+            await asyncio.sleep(STATUS_UPDATE_INTERVAL)
+            message = self.pending_status
+            if not message or getattr(status_msg, 'deleted', False):
+                continue
+            self.pending_status = None
+            try:
+                await self.client.edit_message(status_msg, message)
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении статуса: {str(e)}")
+
+    async def join_one(self, link: str, results: Dict):
+        """Вступление в один канал с учетом квоты и ошибок Telegram"""
+        try:
+            # Ждем, пока квота позволит вступить, но слот не занимаем:
+            # неудачная попытка не должна задерживать следующую ссылку
+            while not self.join_limiter.has_capacity():
+                await asyncio.sleep(1)
+            
+            if '/joinchat/' in link or '+' in link:
+                invite_hash = link.rsplit('/', 1)[-1]
+                await self.client(ImportChatInviteRequest(invite_hash))
+            else:
+                username = link.rsplit('/', 1)[-1]
+                await self.client(JoinChannelRequest(username))
+            
+            # Слот квоты расходуется только успешным вступлением
+            await self.join_limiter.acquire()
+            results["success"] += 1
+            self.join_count += 1
+            logger.info(f"Успешно вступил в канал: {link}")
+                
+        except FloodWaitError as e:
+            wait_time = e.seconds
+            logger.error(f"Нужно подождать {wait_time} секунд перед следующей попыткой")
+            results["failed_chats"].append({
+                "link": link,
+                "error": f"Нужно подождать {wait_time} секунд"
+            })
+            results["failed"] += 1
+            
+            self.pending_status = (
+                f"⚠️ Превышен лимит вступлений\n\n"
+                f"Нужно подождать {wait_time} секунд\n"
+                f"Успешно обработано: {results['success']} каналов"
+            )
+            
+            # Ждем ровно столько, сколько сообщил сервер
+            await asyncio.sleep(wait_time)
+            
+        except Exception as e:
+            error_str = str(e).lower()
+            if "captcha" in error_str:
+                logger.warning(f"Требуется капча для канала: {link}")
+                results["captcha_required"].append(link)
+                results["failed"] += 1
+            else:
+                logger.error(f"Ошибка при вступлении в канал {link}: {str(e)}")
+                results["failed_chats"].append({
+                    "link": link,
+                    "error": str(e)
+                })
+                results["failed"] += 1
+
+    async def join_chats(self, chat_links: List[str], status_msg) -> Dict:
+        results = self.new_join_results()
+
         try:
             if not chat_links:
                 return {"error": "Список каналов пуст"}
@@ -531,146 +837,83 @@ class UserAccount:
             if not self.client:
                 return {"error": "Клиент не инициализирован"}
                 
-            if not self.client.is_connected():
-                logger.info("Подключаюсь к Telegram...")
-                await self.client.connect()
+            await self.ensure_connected()
                 
             if not await self.client.is_user_authorized():
                 return {"error": "Клиент не авторизован"}
 
+            # Обработчик загрузки только что запросил диалоги, берем их из кэша
+            me, dialogs = await self.get_cached_me_and_dialogs()
+            self.ensure_join_limiter(me)
+
             # Проверяем, в каких чатах мы уже состоим
-            dialogs = await self.client.get_dialogs()
             existing_chats = {d.entity.username.lower(): d.entity for d in dialogs if d.is_channel and d.entity.username}
             
+            # Имена каналов из ссылок вычисляем один раз и используем повторно
+            link_usernames = [link.rsplit('/', 1)[-1].lower() for link in chat_links]
+            
             # Подсчитываем количество чатов из списка, в которых мы уже состоим
-            for link in chat_links:
-                try:
-                    username = link.split('/')[-1].lower()
-                    if username in existing_chats:
-                        results["already_member"] += 1
-                except:
-                    continue
+            results["already_member"] = sum(1 for username in link_usernames if username in existing_chats)
 
-            start_time = datetime.now()
+            # Для замеров времени используем монотонные часы: они дешевле datetime
+            start_time = time.monotonic()
             total_channels = len(chat_links)
             self.join_count = 0
-            self.current_delay = 10
-            last_status_update = datetime.now()
             channels_to_join = total_channels - results["already_member"]
 
-            async def update_status(message):
-                """Безопасное обновление статуса"""
-                try:
-                    nonlocal last_status_update
-                    current_time = datetime.now()
-                    
-                    if (current_time - last_status_update).total_seconds() < 2:
-                        return
-                        
-                    if status_msg and not getattr(status_msg, 'deleted', False):
-                        try:
-                            await self.client.edit_message(status_msg, message)
-                            last_status_update = current_time
-                        except Exception as e:
-                            logger.error(f"Ошибка при обновлении статуса: {str(e)}")
-                except Exception as e:
-                    logger.error(f"Ошибка в update_status: {str(e)}")
+            # Статус копится в pending_status и отправляется фоновой задачей
+            # не чаще раза в STATUS_UPDATE_INTERVAL секунд
+            self.pending_status = None
+            status_task = asyncio.create_task(self.status_pump(status_msg)) if status_msg else None
 
-            for i, link in enumerate(chat_links, 1):
-                try:
-                    time_passed = datetime.now() - start_time
-                    if i > 1:
-                        time_per_channel = time_passed / (i - 1)
-                        channels_left = total_channels - i + 1
-                        time_left = time_per_channel * channels_left
-                    else:
-                        time_left = timedelta(0)
+            try:
+                for i, (link, username) in enumerate(zip(chat_links, link_usernames), 1):
+                    try:
+                        # Проверяем, не состоим ли мы уже в этом канале
+                        if username in existing_chats:
+                            continue
 
-                    # Проверяем, не состоим ли мы уже в этом канале
-                    username = link.split('/')[-1].lower()
-                    if username in existing_chats:
-                        continue
+                        time_passed = time.monotonic() - start_time
+                        if i > 1:
+                            time_per_channel = time_passed / (i - 1)
+                            channels_left = total_channels - i + 1
+                            time_left = time_per_channel * channels_left
+                        else:
+                            time_left = 0
 
-                    status_text = (
-                        f"🔄 Обработка каналов\n\n"
-                        f"📊 Прогресс вступления: {results['success']}/{channels_to_join} ({(results['success']/channels_to_join*100 if channels_to_join > 0 else 0):.1f}%)\n"
-                        f"📋 Всего каналов в списке: {total_channels}\n"
-                        f"👥 Уже состоим в каналах: {results['already_member']}\n"
-                        f"✅ Успешно вступили: {results['success']}\n"
-                        f"❌ Ошибки: {results['failed']}\n"
-                        f"⚠️ Капча: {len(results['captcha_required'])}\n"
-                        f"⏳ Прошло времени: {str(time_passed).split('.')[0]}\n"
-                        f"⌛️ Осталось примерно: {str(time_left).split('.')[0]}\n"
-                        f"⏰ Текущая пауза: {self.current_delay:.1f} сек\n\n"
-                        f"🔄 Обрабатываю: {link}"
-                    )
-                    await update_status(status_text)
+                        status_text = (
+                            f"🔄 Обработка каналов\n\n"
+                            f"📊 Прогресс вступления: {results['success']}/{channels_to_join} ({(results['success']/channels_to_join*100 if channels_to_join > 0 else 0):.1f}%)\n"
+                            f"📋 Всего каналов в списке: {total_channels}\n"
+                            f"👥 Уже состоим в каналах: {results['already_member']}\n"
+                            f"✅ Успешно вступили: {results['success']}\n"
+                            f"❌ Ошибки: {results['failed']}\n"
+                            f"⚠️ Капча: {len(results['captcha_required'])}\n"
+                            f"⏳ Прошло времени: {timedelta(seconds=int(time_passed))}\n"
+                            f"⌛️ Осталось примерно: {timedelta(seconds=int(time_left))}\n"
+                            f"⏰ Темп: 1 вступление в {int(self.join_limiter.time_period)} сек\n\n"
+                            f"🔄 Обрабатываю: {link}"
+                        )
+                        self.pending_status = status_text
 
-                    try:
-                        if '/joinchat/' in link or '+' in link:
-                            invite_hash = link.split('/')[-1]
-                            chat = await self.client(ImportChatInviteRequest(invite_hash))
-                        else:
-                            username = link.split('/')[-1]
-                            chat = await self.client(JoinChannelRequest(username))
-                        
-                        results["success"] += 1
-                        self.join_count += 1
-                        logger.info(f"Успешно вступил в канал: {link}")
-                        
-                        if self.join_count == 1:
-                            self.current_delay = 10
-                        elif self.join_count == 2:
-                            self.current_delay = 60
-                        else:
-                            self.current_delay = min(600, self.current_delay * 1.1)
-                            
-                        logger.info(f"Ожидание {self.current_delay} секунд перед следующим вступлением")
-                        await asyncio.sleep(self.current_delay)
-                            
-                    except FloodWaitError as e:
-                        wait_time = e.seconds
-                        logger.error(f"Нужно подождать {wait_time} секунд перед следующей попыткой")
+                        await self.join_one(link, results)
+
+                    except Exception as e:
+                        logger.error(f"Ошибка при обработке канала {link}: {str(e)}")
+                        results["failed"] += 1
                         results["failed_chats"].append({
                             "link": link,
-                            "error": f"Нужно подождать {wait_time} секунд"
+                            "error": str(e)
                         })
-                        results["failed"] += 1
-                        
-                        await update_status(
-                            f"⚠️ Превышен лимит вступлений\n\n"
-                            f"Нужно подождать {wait_time} секунд\n"
-                            f"Успешно обработано: {results['success']} каналов"
-                        )
-                        
-                        await asyncio.sleep(wait_time)
-                        self.current_delay = 10
-                        continue
-                        
-                    except Exception as e:
-                        error_str = str(e).lower()
-                        if "captcha" in error_str:
-                            logger.warning(f"Требуется капча для канала: {link}")
-                            results["captcha_required"].append(link)
-                            results["failed"] += 1
-                        else:
-                            logger.error(f"Ошибка при вступлении в канал {link}: {str(e)}")
-                            results["failed_chats"].append({
-                                "link": link,
-                                "error": str(e)
-                            })
-                            results["failed"] += 1
-                            
-                            # Пропускаем ожидание при ошибке
-                            continue
-                            
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке канала {link}: {str(e)}")
-                    results["failed"] += 1
-                    results["failed_chats"].append({
-                        "link": link,
-                        "error": str(e)
-                    })
+            finally:
+                if status_task:
+                    status_task.cancel()
+                    try:
+                        await status_task
+                    except asyncio.CancelledError:
+                        pass
+                # Список диалогов после вступлений изменился
+                self.dialogs_cache.invalidate()
 
             final_status = (
                 f"✅ Обработка завершена\n\n"
@@ -678,7 +921,7 @@ class UserAccount:
                 f"Успешно: {results['success']}\n"
                 f"С ошибками: {results['failed']}\n"
                 f"Требуется капча: {len(results['captcha_required'])}\n"
-                f"Время выполнения: {str(datetime.now() - start_time).split('.')[0]}"
+                f"Время выполнения: {timedelta(seconds=int(time.monotonic() - start_time))}"
             )
             
             try:
@@ -691,11 +934,12 @@ class UserAccount:
                 except Exception as send_error:
                     logger.error(f"Ошибка при отправке финального статуса: {str(send_error)}")
 
+            return results
+
         except Exception as e:
+            # CancelledError не перехватываем, чтобы отмена задачи доходила до вызывающего
             logger.error(f"Ошибка в процессе вступления в каналы: {str(e)}")
-            return {"error": str(e)}
-        finally:
-            return results
+            return {"error": str(e), **results}
 
 class TelegramBot:
     def __init__(self):
@@ -712,6 +956,10 @@ class TelegramBot:
         self.resource_manager = ResourceManager()
         self.user_states = {}
         self.user_accounts = {}
+        self.account_last_use = {}  # user_id -> время последнего обращения к аккаунту
+        self.evicted_phones = {}  # user_id -> телефон аккаунта, отключенного по простою
+        self.account_info_cache = {}  # user_id -> (время получения, информация об аккаунте)
+        self.session_index = {}  # Телефон -> имя файла сессии пользователя
         self.session_name = 'bot_session'  # Фиксированное имя сессии для бота
         self.cleanup_task = None
 
@@ -724,6 +972,9 @@ class TelegramBot:
             # Подключаемся к Telegram
             await self.client.start(bot_token=self.bot_token)
             
+            # Один раз сканируем каталог сессий, дальше индекс обновляется по ходу работы
+            self.load_session_index()
+            
             # Настраиваем обработчики команд
             self.setup_handlers()
             
@@ -739,36 +990,122 @@ class TelegramBot:
                 await self.client.disconnect()
             return False
 
+    def load_session_index(self):
+        """Заполнение индекса сессий пользователей по файлам в каталоге сессий"""
+        self.session_index.clear()
+        for session_file in os.listdir(SESSIONS_DIR):
+            if session_file.startswith('user_') and not session_file.endswith('.lock'):
+                # Извлекаем номер из имени файла user_PHONE
+                phone = session_file[5:].split('.')[0].split('_')[0]
+                self.session_index[phone] = session_file
+        logger.info(f"Найдено сессий пользователей: {len(self.session_index)}")
+
+    def index_session(self, account: UserAccount):
+        """Добавление сессии авторизованного аккаунта в индекс"""
+        self.session_index[account.phone] = f"{account.session_name}.session"
+
+    def remember_account(self, user_id: int, account: UserAccount):
+        """Сохранение подключенного аккаунта пользователя"""
+        self.user_accounts[user_id] = account
+        self.account_last_use[user_id] = time.monotonic()
+        self.evicted_phones.pop(user_id, None)
+
+    async def get_user_account(self, user_id: int) -> Optional[UserAccount]:
+        """Получение подключенного аккаунта, с переподключением после простоя"""
+        account = self.user_accounts.get(user_id)
+        if account:
+            self.account_last_use[user_id] = time.monotonic()
+            return account
+        
+        # Аккаунт был отключен по простою: восстанавливаем сохраненную сессию
+        phone = self.evicted_phones.get(user_id)
+        if not phone:
+            return None
+        account = UserAccount(phone, self.api_id, self.api_hash, self.session_manager)
+        try:
+            if await account.resume_session():
+                self.remember_account(user_id, account)
+                return account
+        except Exception as e:
+            logger.error(f"Ошибка при переподключении аккаунта {phone}: {str(e)}")
+        await account.disconnect()
+        return None
+
+    async def evict_idle_accounts(self):
+        """Отключение аккаунтов, которыми давно не пользовались"""
+        now = time.monotonic()
+        # Аккаунты, занятые обработкой файла, не трогаем
+        candidates = sorted(
+            (last_use, user_id) for user_id, last_use in self.account_last_use.items()
+            if self.user_states.get(user_id, {}).get('step') != 'processing_file'
+        )
+        overflow = len(self.user_accounts) - MAX_ACCOUNTS
+        for last_use, user_id in candidates:
+            if now - last_use <= ACCOUNT_IDLE_TIMEOUT and overflow <= 0:
+                break
+            account = self.user_accounts.pop(user_id, None)
+            self.account_last_use.pop(user_id, None)
+            self.account_info_cache.pop(user_id, None)
+            overflow -= 1
+            if not account:
+                continue
+            self.evicted_phones[user_id] = account.phone
+            try:
+                await account.disconnect()
+            except Exception as e:
+                logger.error(f"Ошибка при отключении пользователя {user_id}: {str(e)}")
+            # Отключенный по простою клиент не держим в памяти
+            TELEGRAM_CLIENTS.pop(account.session_name, None)
+            logger.info(f"Аккаунт пользователя {user_id} отключен по простою")
+
     async def get_or_create_user_account(self, user_id: int, phone: str = None) -> Optional[UserAccount]:
         """Получение существующего или создание нового аккаунта пользователя"""
         try:
-            # Если аккаунт уже существует в памяти, возвращаем его
-            if user_id in self.user_accounts:
-                return self.user_accounts[user_id]
+            # Если аккаунт уже подключен или был отключен по простою, возвращаем его
+            account = await self.get_user_account(user_id)
+            if account:
+                return account
             
             # Если телефон не указан, ищем существующий файл сессии
             if not phone:
-                # Ищем все файлы сессий
-                session_files = [f for f in os.listdir(SESSIONS_DIR) 
-                               if f.startswith('user_') and not f.endswith('.lock')]
-                for session_file in session_files:
-                    try:
-                        # Извлекаем номер из имени файла user_PHONE
-                        temp_phone = session_file[5:].split('.')[0].split('_')[0]
-                        temp_account = UserAccount(temp_phone, self.api_id, self.api_hash, self.session_manager)
-                        if await temp_account.start_client():
-                            # Если успешно подключились, сохраняем аккаунт
-                            self.user_accounts[user_id] = temp_account
-                            return temp_account
-                        await temp_account.disconnect()
-                    except Exception as e:
-                        logger.error(f"Ошибка при проверке сессии {session_file}: {str(e)}")
-                return None
+                # Сессии подключенных и отключенных по простою аккаунтов принадлежат
+                # другим пользователям, их не проверяем
+                taken_phones = {account.phone for account in self.user_accounts.values()}
+                taken_phones.update(self.evicted_phones.values())
+                session_files = [f for phone, f in self.session_index.items() if phone not in taken_phones]
+                
+                # Проверяем свободные сессии параллельно и берем первую авторизованную
+                pending = {asyncio.create_task(self.probe_session(f)) for f in session_files}
+                account = None
+                try:
+                    while pending and account is None:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            result = task.result()
+                            if result is None:
+                                continue
+                            if account is None:
+                                account = result
+                            else:
+                                await result.disconnect()
+                finally:
+                    # Остальные проверки отменяем, а успевшие подключиться аккаунты отключаем
+                    for task in pending:
+                        task.cancel()
+                    for result in await asyncio.gather(*pending, return_exceptions=True):
+                        if isinstance(result, UserAccount):
+                            await result.disconnect()
+                
+                if account:
+                    # Если успешно подключились, сохраняем аккаунт
+                    self.remember_account(user_id, account)
+                return account
             
             # Создаем новый аккаунт с указанным телефоном
             account = UserAccount(phone, self.api_id, self.api_hash, self.session_manager)
             if await account.start_client():
-                self.user_accounts[user_id] = account
+                self.remember_account(user_id, account)
+                self.index_session(account)
                 return account
             return None
             
@@ -776,6 +1113,35 @@ class TelegramBot:
             logger.error(f"Ошибка при получении/создании аккаунта: {str(e)}")
             return None
 
+    async def probe_session(self, session_file: str) -> Optional[UserAccount]:
+        """Проверка файла сессии: возвращает аккаунт, если сессия авторизована"""
+        # Извлекаем номер из имени файла user_PHONE
+        temp_phone = session_file[5:].split('.')[0].split('_')[0]
+        temp_account = UserAccount(temp_phone, self.api_id, self.api_hash, self.session_manager)
+        authorized = False
+        try:
+            authorized = await temp_account.resume_session()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при проверке сессии {session_file}: {str(e)}")
+        finally:
+            if not authorized:
+                await temp_account.disconnect()
+        return temp_account if authorized else None
+
+    async def get_cached_account_info(self, user_id: int, account: UserAccount) -> Optional[Dict]:
+        """Информация об аккаунте пользователя с кэшированием на ACCOUNT_INFO_TTL секунд"""
+        now = time.monotonic()
+        cached_at, account_info = self.account_info_cache.get(user_id, (0, None))
+        if account_info and now - cached_at < ACCOUNT_INFO_TTL:
+            return account_info
+        
+        account_info = await account.get_account_info()
+        if account_info:
+            self.account_info_cache[user_id] = (now, account_info)
+        return account_info
+
     def setup_handlers(self):
         """Настройка обработчиков команд"""
         
@@ -789,23 +1155,10 @@ class TelegramBot:
             
             if account:
                 # Если нашли существующий аккаунт
-                account_info = await account.get_account_info()
+                account_info = await self.get_cached_account_info(user_id, account)
                 if account_info:
                     await event.respond(
-                        f"👋 С возвращением!\n\n"
-                        f"👤 Пользователь: {account_info['first_name']}\n"
-                        f"📱 Телефон: {account_info['phone']}\n"
-                        f"💎 Тип аккаунта: {account_info['account_type']}\n\n"
-                        f"📊 Статистика чатов:\n"
-                        f"📢 Каналы: {account_info['channels']}\n"
-                        f"👥 Большие группы (>200): {account_info['large_groups']}\n"
-                        f"👥 Малые группы (≤200): {account_info['small_groups']}\n"
-                        f"👤 Личные чаты: {account_info['private_chats']}\n"
-                        f"📱 Всего чатов: {account_info['total_chats']}\n\n"
-                        f"📈 Лимиты:\n"
-                        f"📊 Каналы + большие группы: {account_info['limited_chats']}/{account_info['limits']['max_limited_chats']}\n"
-                        f"➕ Доступно для вступления: {account_info['available_joins']}\n"
-                        f"📥 Лимит вступлений в день: {account_info['limits']['joins_per_day']}",
+                        WELCOME_BACK_TEMPLATE.format_map(account_info),
                         buttons=[
                             [Button.text("📥 Загрузить список каналов", resize=True)],
                             [Button.text("📊 Статистика", resize=True)]
@@ -838,22 +1191,24 @@ class TelegramBot:
         async def phone_handler(event):
             """Обработчик ввода номера телефона"""
             sender = event.sender_id
-            if sender not in self.user_states or self.user_states[sender].get('step') != 'waiting_phone':
+            state = self.user_states.get(sender)
+            if not state or state.get('step') != 'waiting_phone':
                 return
 
             phone = event.text
             try:
                 # Создаем аккаунт пользователя
                 user_account = UserAccount(phone, self.api_id, self.api_hash, self.session_manager)
-                self.user_states[sender]['account'] = user_account
+                state['account'] = user_account
                 
                 # Отправляем сообщение о проверке кода в терминале
                 status_msg = await event.respond("🔄 Проверьте терминал для ввода кода подтверждения...")
                 
                 # Запускаем клиент и проходим авторизацию через терминал
                 if await user_account.start_client():
-                    self.user_accounts[sender] = user_account
-                    del self.user_states[sender]
+                    self.remember_account(sender, user_account)
+                    self.index_session(user_account)
+                    self.user_states.pop(sender, None)
                     
                     # Получаем информацию об аккаунте
                     account_info = await user_account.get_account_info()
@@ -879,7 +1234,7 @@ class TelegramBot:
                             [Button.text("📱 Подключить аккаунт", resize=True)]
                         ]
                     )
-                    del self.user_states[sender]
+                    self.user_states.pop(sender, None)
             except Exception as e:
                 logger.error(f"Ошибка при обработке номера телефона: {str(e)}")
                 await event.respond(
@@ -888,17 +1243,17 @@ class TelegramBot:
                         [Button.text("📱 Подключить аккаунт", resize=True)]
                     ]
                 )
-                if sender in self.user_states:
-                    del self.user_states[sender]
+                self.user_states.pop(sender, None)
 
         @self.client.on(events.NewMessage(pattern='❌ Отменить'))
         async def cancel_handler(event):
             """Обработчик отмены операции"""
             sender = event.sender_id
-            if sender in self.user_states:
-                if 'account' in self.user_states[sender]:
-                    await self.user_states[sender]['account'].disconnect()
-                del self.user_states[sender]
+            state = self.user_states.pop(sender, None)
+            if state and (account := state.get('account')):
+                await account.disconnect()
+                # Авторизация не завершена, такую сессию не нужно проверять при /start
+                self.session_index.pop(account.phone, None)
             
             await event.respond(
                 "❌ Операция отменена",
@@ -911,7 +1266,7 @@ class TelegramBot:
         async def upload_channels_handler(event):
             """Обработчик загрузки списка каналов"""
             sender = event.sender_id
-            if sender not in self.user_accounts:
+            if not await self.get_user_account(sender):
                 await event.respond(
                     "❌ Сначала необходимо подключить аккаунт",
                     buttons=[
@@ -942,23 +1297,24 @@ class TelegramBot:
             sender = event.sender_id
             
             # Проверяем состояние пользователя
-            if sender not in self.user_states:
+            state = self.user_states.get(sender)
+            if not state:
                 await event.respond("❌ Сначала нажмите кнопку 'Загрузить список каналов'")
                 return
                 
-            if self.user_states[sender].get('step') != 'waiting_file':
+            if state.get('step') != 'waiting_file':
                 await event.respond("⚠️ Дождитесь окончания обработки предыдущего файла")
                 return
 
             try:
                 # Устанавливаем состояние обработки
-                self.user_states[sender]['step'] = 'processing_file'
+                state['step'] = 'processing_file'
                 
                 # Отправляем сообщение о начале обработки
                 status_msg = await event.respond("🔄 Обрабатываю файл...")
 
                 # Получаем файл
-                file = await event.message.download_media(file=BytesIO())
+                file = await self.download_upload(event.message)
                 
                 # Извлекаем ссылки из файла
                 links = await self.process_file(file)
@@ -967,7 +1323,8 @@ class TelegramBot:
                     return
 
                 # Проверяем аккаунт пользователя
-                if sender not in self.user_accounts:
+                user_account = await self.get_user_account(sender)
+                if not user_account:
                     await status_msg.edit(
                         "❌ Сначала необходимо войти в аккаунт",
                         buttons=[
@@ -975,40 +1332,37 @@ class TelegramBot:
                         ]
                     )
                     return
-
-                user_account = self.user_accounts[sender]
                 
-                # Извлекаем ссылки на чаты
-                chat_links = await user_account.extract_chat_links("\n".join(links))
-                if not chat_links:
-                    await status_msg.edit("❌ Не найдено корректных ссылок на каналы")
-                    return
-
                 # Получаем информацию об аккаунте
-                me = await user_account.client.get_me()
-                dialogs = await user_account.client.get_dialogs()
+                # Для оценки лимитов нужен актуальный список диалогов
+                user_account.dialogs_cache.invalidate()
+                me, dialogs = await user_account.get_cached_me_and_dialogs()
                 current_chats = len(dialogs)
                 max_chats = 1000 if me.premium else 500
                 available_joins = max_chats - current_chats
                 
-                # Примерное время вступления (60 секунд на канал)
-                estimated_time = len(chat_links) * 60
+                # Примерное время вступления: первое сразу, дальше по одному в join_interval секунд.
+                # Ошибки квоту не расходуют, поэтому это оценка сверху
+                estimated_time = int(max(len(links) - 1, 0) * join_interval(me.premium))
                 hours = estimated_time // 3600
                 minutes = (estimated_time % 3600) // 60
                 
                 # Обновляем статус с информацией об анализе
                 await status_msg.edit(
                     f"📊 Детальный анализ списка:\n\n"
-                    f"📋 Распознано ссылок в файле: {len(links)}\n"
-                    f"✅ Валидных ссылок на каналы: {len(chat_links)}\n"
+                    f"📋 Распознано ссылок на каналы: {len(links)}\n"
                     f"📱 Текущие подписки: {current_chats}/{max_chats}\n"
                     f"➕ Доступно для вступления: {available_joins}\n"
                     f"⌛️ Примерное время выполнения: {hours}ч {minutes}мин\n\n"
                     f"🔄 Начинаю вступление в каналы..."
                 )
 
-                # Запускаем процесс вступления в каналы
-                results = await user_account.join_chats(chat_links, status_msg)
+                # Запускаем процесс вступления в каналы. process_file уже возвращает
+                # канонические ссылки, повторный разбор не нужен
+                results = await user_account.join_chats(links, status_msg)
+                
+                # После вступлений статистика аккаунта устарела
+                self.account_info_cache.pop(sender, None)
                 
                 if "error" in results:
                     await status_msg.edit(f"❌ Ошибка: {results['error']}")
@@ -1047,94 +1401,96 @@ class TelegramBot:
                 )
             finally:
                 # Очищаем состояние пользователя
-                if sender in self.user_states:
-                    del self.user_states[sender]
+                self.user_states.pop(sender, None)
+
+    async def download_upload(self, message: Message) -> BytesIO:
+        """Потоковое скачивание загруженного файла с ограничением размера"""
+        # Заведомо большие файлы отклоняем по размеру из метаданных, не скачивая
+        if message.file and message.file.size and message.file.size > MAX_UPLOAD_SIZE:
+            raise ValueError(f"файл больше {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ")
+        
+        buffer = BytesIO()
+        total = 0
+        async for chunk in self.client.iter_download(message.media, request_size=UPLOAD_CHUNK_SIZE):
+            total += len(chunk)
+            if total > MAX_UPLOAD_SIZE:
+                raise ValueError(f"файл больше {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ")
+            buffer.write(chunk)
+        return buffer
 
     async def process_file(self, file: BytesIO) -> List[str]:
         """Обработка загруженного файла и извлечение ссылок"""
         links = []
-        seen = set()
+        seen = set()  # Уже добавленные канонические ссылки
+        # Отдельные ссылки пишем в лог только на уровне DEBUG
+        debug = logger.isEnabledFor(logging.DEBUG)
+        
+        def add_links(text: str):
+            """Добавление канонических ссылок из текста за один проход выражения"""
+            for match in FILE_LINK_RE.finditer(text):
+                link = chat_link_from_match(match)
+                if link in seen:
+                    continue
+                seen.add(link)
+                links.append(link)
+                if debug:
+                    logger.debug("Найдена ссылка: %s", link)
         
         try:
-            # Пробуем прочитать как Excel
-            try:
-                import pandas as pd
-                df = pd.read_excel(file)
-                
-                for column in df.columns:
-                    for value in df[column].dropna():
-                        value = str(value).strip()
-                        if value:
-                            logger.info(f"Найдено значение в Excel: {value}")
-                            if value.startswith(('https://t.me/', 'http://t.me/', '@', 't.me/')):
-                                links.append(value)
-                                logger.info(f"Добавлена ссылка из Excel: {value}")
-                                
-            except Exception as e:
-                logger.error(f"Ошибка при чтении Excel: {str(e)}")
+            # Файл уже в памяти: формат определяем по сигнатуре, а не перебором парсеров
+            raw = file.getvalue()
+            
+            if raw.startswith((XLSX_MAGIC, XLS_MAGIC)):
+                try:
+                    # Ячейки читаем напрямую через openpyxl/xlrd, без построения DataFrame
+                    if raw.startswith(XLSX_MAGIC):
+                        # В режиме read_only строки разбираются потоково, без загрузки всей книги
+                        file.seek(0)
+                        workbook = load_workbook(file, read_only=True, data_only=True)
+                        rows = (row for sheet in workbook.worksheets for row in sheet.iter_rows(values_only=True))
+                        close_workbook = workbook.close
+                    else:
+                        workbook = xlrd.open_workbook(file_contents=raw)
+                        rows = (sheet.row_values(i) for sheet in workbook.sheets() for i in range(sheet.nrows))
+                        close_workbook = workbook.release_resources
+                    
+                    try:
+                        for row in rows:
+                            for value in row:
+                                # Ссылки могут быть только в строковых ячейках
+                                if not isinstance(value, str):
+                                    continue
+                                value = value.strip()
+                                if value.startswith(CHAT_LINK_PREFIXES):
+                                    add_links(value)
+                    finally:
+                        close_workbook()
+                                    
+                except Exception as e:
+                    logger.error(f"Ошибка при чтении Excel: {str(e)}")
                 
             # Если Excel не сработал, пробуем текстовые форматы
             if not links:
                 logger.info("Пробуем текстовые форматы...")
-                file.seek(0)
                 
-                # Пробуем разные кодировки
-                encodings = ['utf-8', 'windows-1251', 'cp1251']
-                
-                for encoding in encodings:
+                # Пробуем разные кодировки прямо в памяти
+                content = None
+                for encoding in ('utf-8', 'windows-1251', 'cp1251'):
                     try:
-                        # Создаем временный файл
-                        with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp:
-                            temp.write(file.read())
-                            temp_path = temp.name
-                            
-                        # Читаем файл с текущей кодировкой
-                        with open(temp_path, 'r', encoding=encoding) as f:
-                            content = f.read()
-                            # Ищем все ссылки в тексте
-                            tg_links = re.findall(r'(?:https?://)?(?:t\.me|telegram\.me)/[a-zA-Z0-9_@/+-]+', content)
-                            username_links = re.findall(r'@[a-zA-Z][a-zA-Z0-9_]{3,}(?:\s|$)', content)
-                            
-                            for link in tg_links:
-                                if link not in links:
-                                    logger.info(f"Найдена ссылка в тексте: {link}")
-                                    links.append(link)
-                            
-                            for username in username_links:
-                                username = username.strip()
-                                if username not in links:
-                                    logger.info(f"Найден юзернейм: {username}")
-                                    links.append(username)
-                                    
-                        # Удаляем временный файл
-                        os.unlink(temp_path)
-                        break  # Если успешно прочитали файл, выходим из цикла
-                        
-                    except Exception as e:
+                        content = raw.decode(encoding)
+                        break
+                    except UnicodeDecodeError as e:
                         logger.error(f"Ошибка при чтении с кодировкой {encoding}: {str(e)}")
-                        continue
+                        
+                if content is not None:
+                    add_links(content)
                         
         except Exception as e:
             logger.error(f"Ошибка при обработке файла: {str(e)}")
             return []
-            
-        # Нормализуем ссылки
-        normalized_links = []
-        for link in links:
-            # Убираем @ для юзернеймов
-            if link.startswith('@'):
-                link = link[1:]
-                
-            # Проверяем что ссылка начинается с http:// или https://
-            if not link.startswith(('http://', 'https://')):
-                link = f"https://t.me/{link}"
-            
-            if link not in seen:
-                seen.add(link)
-                normalized_links.append(link)
-                logger.info(f"Нормализована ссылка: {link}")
-                
-        return normalized_links
+        
+        logger.info("Обработка файла: найдено %d ссылок", len(links))
+        return links
 
     async def periodic_cleanup(self):
         """Периодическая очистка временных файлов"""
@@ -1142,7 +1498,9 @@ class TelegramBot:
             try:
                 self.resource_manager.cleanup_old_files(SCREENSHOTS_DIR)
                 self.resource_manager.cleanup_old_files(SESSIONS_DIR)
-                await asyncio.sleep(3600)  # Очистка каждый час
+                await self.evict_idle_accounts()
+                
+                await asyncio.sleep(CLEANUP_INTERVAL)
             except asyncio.CancelledError:
                 break
             except Exception as e:
@@ -1169,6 +1527,9 @@ class TelegramBot:
                 finally:
                     self.user_accounts.pop(user_id, None)
             
+            # Отключаем оставшиеся клиенты пользователей
+            await disconnect_all_clients()
+            
             # Отключаем бота
             if self.client:
                 try:
@@ -1197,6 +1558,7 @@ class TelegramBot:
             # Очищаем все состояния
             self.user_states.clear()
             self.user_accounts.clear()
+            self.account_last_use.clear()
 
     async def run(self):
         """Запуск бота с корректной обработкой завершения"""
@@ -1234,7 +1596,7 @@ class TelegramBot:
             "https://t.me/vopros_ysmp"
         ]
         
-        links = await self.extract_chat_links("\n".join(test_links))
+        links = UserAccount.extract_chat_links(test_links)
         logger.info(f"Результат обработки ссылок:")
         for link in links:
             logger.info(f"Обработана ссылка: {link}")
@@ -1242,12 +1604,7 @@ class TelegramBot:
 
 if __name__ == "__main__":
     try:
-        # Проверяем наличие необходимых директорий
-        for directory in [LOGS_DIR, SESSIONS_DIR, SCREENSHOTS_DIR]:
-            if not os.path.exists(directory):
-                os.makedirs(directory, exist_ok=True)
-                logger.info(f"Создана директория: {directory}")
-
+        # Директории создаются при загрузке модуля через os.makedirs(exist_ok=True)
         # Запускаем бота
         bot = TelegramBot()
         asyncio.run(bot.run())